@@ -2,96 +2,493 @@ import os
 import chainlit as cl
 from azure.ai.projects.aio import AIProjectClient
 from azure.identity.aio import DefaultAzureCredential
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import ClientAuthenticationError, ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.ai.agents.models import (
     AgentStreamEvent,
-    MessageDeltaChunk,
     ThreadMessage,
     ThreadRun,
     RunStep,
-    ListSortOrder
+    ThreadMessageOptions
 )
+import aiohttp
+import atexit
 import logging
+import queue
 import asyncio
-from typing import Optional
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging: records are queued and written by a background
+# thread, so the event loop never blocks on stdout/stderr pipe writes.
+# The chainlit CLI configures the root logger before importing this
+# module, so its handlers are moved behind the queue rather than replaced.
+_root_logger = logging.getLogger()
+if not _root_logger.handlers:
+    logging.basicConfig(level=logging.INFO)
+# A module reload must not queue the existing QueueHandler onto itself
+if not any(isinstance(h, QueueHandler) for h in _root_logger.handlers):
+    _log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _log_handlers = list(_root_logger.handlers)
+    for _handler in _log_handlers:
+        _root_logger.removeHandler(_handler)
+    _root_logger.addHandler(QueueHandler(_log_queue))
+    _log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Environment variables
 PROJECT_ENDPOINT = os.getenv("PROJECT_ENDPOINT")
 AGENT_ID = os.getenv("AZURE_AI_AGENT_ID")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+MAX_CONCURRENT_RUNS = int(os.getenv("MAX_CONCURRENT_RUNS", "32"))
+SKIP_WARMUP = bool(os.getenv("SKIP_WARMUP"))
+APP_DEBUG = os.getenv("APP_DEBUG") == "1"
+
+# Mandatory configuration is checked once here rather than per session
+CONFIG_OK = bool(PROJECT_ENDPOINT and AGENT_ID)
+CONFIG_ERROR = "PROJECT_ENDPOINT and AZURE_AI_AGENT_ID environment variables are required"
+
+# Verbose run/stream tracing from this module is opt-in
+if APP_DEBUG:
+    logger.setLevel(logging.DEBUG)
+
+# Run polling: exponential backoff with jitter, bounded by a cap
+# A cancelling run still blocks new messages on its thread
+ACTIVE_RUN_STATUSES = ("queued", "in_progress", "requires_action", "cancelling")
+POLL_INITIAL_DELAY = 0.05
+POLL_MAX_DELAY = 2.0
+WAKE_UP_TIMEOUT = 30
+
+# Stream event types, compared by value since the SDK yields plain strings
+_DELTA_EVENT = AgentStreamEvent.THREAD_MESSAGE_DELTA.value
+_ERROR_EVENT = AgentStreamEvent.ERROR.value
+_DONE_EVENT = AgentStreamEvent.DONE.value
+_RUN_FAILED_EVENTS = frozenset((
+    AgentStreamEvent.THREAD_RUN_FAILED.value,
+    AgentStreamEvent.THREAD_RUN_CANCELLED.value,
+    AgentStreamEvent.THREAD_RUN_EXPIRED.value,
+    AgentStreamEvent.THREAD_RUN_INCOMPLETE.value
+))
+
+# UI streaming: flush buffered deltas at most this often or every N deltas
+UI_FLUSH_INTERVAL = 0.05
+UI_FLUSH_TOKENS = 16
+
+# Static UI messages, built once at import; templates take agent_id/thread_id
+INIT_PENDING_MSG = "🤖 Initializing Azure AI Agent..."
+THINKING_MSG = "🤖 *Thinking...*"
+QUEUED_MSG = "⏳ *Queued - I'll answer this as soon as the current reply finishes.*"
+COMBINED_MSG = "↪️ *Answered together with your follow-up below.*"
+UNANSWERED_MSG = "⏹️ *Not answered - the reply before this message was stopped.*"
+INIT_INCOMPLETE_MSG = "❌ Agent initialization incomplete."
+INIT_FAILURE_MSG = "❌ Failed to connect to Azure AI Agent. Please check configuration."
+RESUMED_READY_MSG = (
+    "✅ Connected to Azure AI Agent: {agent_id}\n"
+    "Resumed conversation in thread: {thread_id}\n\n"
+    "Welcome back! The agent is ready to continue your conversation."
+)
+THREAD_REPLACED_MSG = (
+    "⚠️ Your previous conversation thread no longer exists, so this reply "
+    "starts a new thread without the earlier history."
+)
+NEW_THREAD_READY_MSG = (
+    "✅ Connected to Azure AI Agent: {agent_id}\n"
+    "New conversation thread: {thread_id}\n\n"
+    "Agent is ready! How can I help you?"
+)
+
+def _run_error_message(run) -> str:
+    """Get the service-reported reason a run ended unsuccessfully"""
+    error = getattr(run, "last_error", None)
+    if getattr(error, "message", None):
+        return error.message
+    # Incomplete runs report a reason (e.g. token limits) instead of an error
+    details = getattr(run, "incomplete_details", None)
+    return getattr(details, "reason", None) or "Unknown error"
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds, ignoring other forms"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+# Refresh cached tokens once they are this close to expiry
+TOKEN_REFRESH_MARGIN = 300
+
+class CachingCredential:
+    """Async credential wrapper that reuses tokens until they near expiry"""
+    def __init__(self, inner):
+        self._inner = inner
+        self._token_cache: Dict[Tuple[str, ...], AccessToken] = {}
+    
+    async def get_token(self, *scopes: str, **kwargs) -> AccessToken:
+        """Return a cached token for the scopes, delegating only when it is stale"""
+        # Claims challenges must always reach the underlying credential
+        if kwargs.get("claims"):
+            return await self._inner.get_token(*scopes, **kwargs)
+        
+        key = scopes + (kwargs.get("tenant_id") or "",)
+        token = self._token_cache.get(key)
+        if token and token.expires_on - time.time() > TOKEN_REFRESH_MARGIN:
+            return token
+        
+        token = await self._inner.get_token(*scopes, **kwargs)
+        self._token_cache[key] = token
+        return token
+    
+    async def close(self) -> None:
+        await self._inner.close()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+# Shared by every session so tokens are acquired once per process
+# Skip developer-tool credentials that never resolve on App Service
+credential = CachingCredential(DefaultAzureCredential(
+    exclude_visual_studio_code_credential=True,
+    exclude_shared_token_cache_credential=True
+))
+
+# Project client and agent handle shared by every session, so all chats
+# reuse one HTTP connection pool instead of re-handshaking per session
+_project_client: Optional[AIProjectClient] = None
+_agent = None
+_client_lock = asyncio.Lock()
+_agent_lock = asyncio.Lock()
+
+def _create_transport() -> AioHttpTransport:
+    """Build an aiohttp transport whose pool is sized for concurrent chats"""
+    # Mirror the session settings azure-core uses for its own default session
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE,
+            keepalive_timeout=60
+        ),
+        trust_env=True,
+        auto_decompress=False,
+        cookie_jar=aiohttp.DummyCookieJar()
+    )
+    return AioHttpTransport(session=session, session_owner=True)
+
+async def get_project_client() -> AIProjectClient:
+    """Get the process-wide project client, creating it on first use"""
+    global _project_client
+    async with _client_lock:
+        if _project_client is None:
+            if not PROJECT_ENDPOINT:
+                raise Exception("PROJECT_ENDPOINT environment variable is required")
+            _project_client = AIProjectClient(
+                endpoint=PROJECT_ENDPOINT,
+                credential=credential,
+                transport=_create_transport()
+            )
+        return _project_client
+
+async def get_agent():
+    """Get the configured agent, fetching it once per process"""
+    global _agent
+    async with _agent_lock:
+        if _agent is None:
+            if not AGENT_ID:
+                raise Exception("AZURE_AI_AGENT_ID environment variable is required")
+            project_client = await get_project_client()
+            _agent = await project_client.agents.get_agent(AGENT_ID)
+        return _agent
+
+async def close_shared_clients() -> None:
+    """Close the process-wide project client and credential"""
+    global _project_client, _agent
+    async with _client_lock:
+        if _project_client is not None:
+            await _project_client.close()
+            _project_client = None
+            _agent = None
+    await credential.close()
+
+class PollScheduler:
+    """Coalesce run-status polls from all sessions into one fan-out per tick"""
+    def __init__(self):
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._delay = POLL_INITIAL_DELAY
+    
+    def register(self, thread_id: str, run_id: str) -> asyncio.Future:
+        """Get a future resolved with the run once it leaves the active statuses"""
+        key = (thread_id, run_id)
+        future = self._pending.get(key)
+        if future is None or future.done():
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+        
+        # Newly registered runs are polled promptly, not after a long backoff
+        self._delay = POLL_INITIAL_DELAY
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+    
+    async def _run(self) -> None:
+        """Poll every pending run once per tick until none remain"""
+        retry_after: list = []
+        
+        def capture_retry_after(response) -> None:
+            # Honor any server-provided Retry-After hint on the next sleep
+            delay_hint = _parse_retry_after(response.http_response.headers.get("Retry-After"))
+            if delay_hint is not None:
+                retry_after.append(delay_hint)
+        
+        try:
+            # Bind the hot-loop callables once rather than per tick
+            get_run = (await get_project_client()).agents.runs.get
+            sleep = asyncio.sleep
+            uniform = random.uniform
+            
+            while self._pending:
+                delay = self._delay
+                await sleep(max(retry_after) if retry_after else delay)
+                retry_after.clear()
+                self._delay = min(POLL_MAX_DELAY, delay * 1.5) + uniform(0, delay * 0.1)
+                
+                # Drop waiters that gave up (e.g. timed out) since the last tick
+                for key in [key for key, future in self._pending.items() if future.done()]:
+                    del self._pending[key]
+                keys = list(self._pending)
+                if not keys:
+                    break
+                
+                results = await asyncio.gather(
+                    *(
+                        get_run(
+                            thread_id=thread_id,
+                            run_id=run_id,
+                            raw_response_hook=capture_retry_after
+                        )
+                        for thread_id, run_id in keys
+                    ),
+                    return_exceptions=True
+                )
+                
+                for key, result in zip(keys, results):
+                    future = self._pending.get(key)
+                    if future is None or future.done():
+                        continue
+                    if isinstance(result, BaseException):
+                        future.set_exception(result)
+                    elif result.status in ACTIVE_RUN_STATUSES:
+                        continue
+                    else:
+                        future.set_result(result)
+                    del self._pending[key]
+        except Exception as e:
+            logger.error("Run polling failed: %s", e)
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            self._pending.clear()
+
+poll_scheduler = PollScheduler()
+
+class AdmissionController:
+    """Bound concurrent agent runs to a fixed cap"""
+    def __init__(self, cap: int):
+        self._cap = cap
+        self._inflight = 0
+        self._cond = asyncio.Condition()
+    
+    async def __aenter__(self) -> "AdmissionController":
+        async with self._cond:
+            try:
+                await self._cond.wait_for(lambda: self._inflight < self._cap)
+            except asyncio.CancelledError:
+                # A waiter cancelled after being notified would swallow the
+                # wake-up; pass it on so a free slot never goes unclaimed
+                self._cond.notify(1)
+                raise
+            self._inflight += 1
+        return self
+    
+    async def __aexit__(self, *args) -> None:
+        async with self._cond:
+            self._inflight -= 1
+            self._cond.notify(1)
+
+# Caps agent runs in flight per process; excess messages wait here cheaply
+run_admission = AdmissionController(MAX_CONCURRENT_RUNS)
+
+class StreamBuffer:
+    """Coalesce reply deltas into fewer Chainlit websocket frames"""
+    def __init__(self, message: cl.Message):
+        self._message = message
+        self._pending: List[str] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._started = False
+        self._loop = asyncio.get_running_loop()
+        self._last_flush = self._loop.time()
+    
+    def push(self, text: str) -> bool:
+        """Buffer a delta; return True if a background flush was scheduled"""
+        self._pending.append(text)
+        if (len(self._pending) < UI_FLUSH_TOKENS
+                and self._loop.time() - self._last_flush < UI_FLUSH_INTERVAL):
+            return False
+        # Keep a single flush in flight; later deltas ride along with the next one
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._send(self._take()))
+            return True
+        return False
+    
+    async def close(self) -> None:
+        """Wait for the in-flight flush, then send anything still buffered"""
+        if self._flush_task is not None:
+            task, self._flush_task = self._flush_task, None
+            await task
+        if self._pending:
+            await self._send(self._take())
+    
+    def discard(self) -> None:
+        """Drop buffered deltas and cancel any flush still in flight"""
+        self._pending.clear()
+        task, self._flush_task = self._flush_task, None
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            # Retrieve a failed flush's exception so it is not reported as lost
+            task.exception()
+    
+    def _take(self) -> str:
+        text = "".join(self._pending)
+        self._pending.clear()
+        self._last_flush = self._loop.time()
+        return text
+    
+    async def _send(self, text: str) -> None:
+        # The first flush replaces the placeholder text
+        first = not self._started
+        self._started = True
+        await self._message.stream_token(text, is_sequence=first)
+
+# Marks a session value that has not been looked up yet (None is a valid value)
+_UNREAD = object()
 
 class AzureAIAgent:
+    __slots__ = (
+        "thread_id",
+        "_initialized",
+        "_connect_lock",
+        "_wake_task",
+        "_run_lock",
+        "_pending_user_msgs",
+        "_pending_batch",
+        "_run_task",
+        "_thread_unverified",
+        "_session_thread_id"
+    )
+    
     def __init__(self):
-        self.project_client: Optional[AIProjectClient] = None
-        self.agents_client = None
-        self.agent = None
-        self.thread = None
-        self.thread_id: Optional[str] = None  # Store thread ID separately
+        # Per-session state is just the thread; client and agent are shared
+        self.thread_id: Optional[str] = None
         self._initialized = False
+        # Set while a resumed thread id has not yet been used successfully
+        self._thread_unverified = False
+        self._connect_lock = asyncio.Lock()
+        self._wake_task: Optional[asyncio.Task] = None
+        self._run_lock = asyncio.Lock()
+        self._pending_user_msgs: List[Tuple[str, cl.Message]] = []
+        # Resolved with the reply once the queued batch has been answered
+        self._pending_batch: Optional[asyncio.Future] = None
+        self._run_task: Optional[asyncio.Task] = None
+        # Mirror of the session's "thread_id"; _UNREAD until first looked up
+        self._session_thread_id = _UNREAD
+    
+    def load_session_thread_id(self) -> Optional[str]:
+        """Thread id stored in the user session, read from the store once"""
+        if self._session_thread_id is _UNREAD:
+            self._session_thread_id = cl.user_session.get("thread_id")
+        return self._session_thread_id
+    
+    def save_session_thread_id(self, thread_id: str) -> None:
+        """Write the thread id to the user session only when it changed"""
+        if thread_id != self._session_thread_id:
+            cl.user_session.set("thread_id", thread_id)
+            self._session_thread_id = thread_id
+    
+    @property
+    def agents_client(self):
+        """Agents operations of the shared project client"""
+        return _project_client.agents if _project_client else None
+    
+    @property
+    def agent(self):
+        """Agent handle shared by every session"""
+        return _agent
         
     async def initialize(self, existing_thread_id: Optional[str] = None) -> bool:
-        """Initialize Azure AI Project client and agent"""
+        """Bind the shared client and agent, then open this session's thread"""
+        if not CONFIG_OK:
+            logger.error(CONFIG_ERROR)
+            return False
+        
         try:
-            # Use async DefaultAzureCredential for authentication
-            credential = DefaultAzureCredential()
-            
-            # Initialize project client with endpoint
-            if PROJECT_ENDPOINT:
-                self.project_client = AIProjectClient(
-                    endpoint=PROJECT_ENDPOINT,
-                    credential=credential
-                )
-                # Get agents client from project client
-                self.agents_client = self.project_client.agents
-            else:
-                raise Exception("PROJECT_ENDPOINT environment variable is required")
-            
-            # Get existing agent by ID
-            if AGENT_ID:
-                self.agent = await self.agents_client.get_agent(AGENT_ID)
-            else:
-                raise Exception("AZURE_AI_AGENT_ID environment variable is required")
+            # Make sure the shared project client and agent handle exist
+            await get_agent()
             
             # Use existing thread or create new one
             if existing_thread_id:
-                try:
-                    # Try to get the existing thread
-                    self.thread = await self.agents_client.threads.get(existing_thread_id)
-                    self.thread_id = existing_thread_id
-                    logger.info(f"Reconnected to existing thread: {self.thread_id}")
-                except Exception as e:
-                    logger.warning(f"Could not reconnect to thread {existing_thread_id}: {e}")
-                    # Fall back to creating new thread
-                    self.thread = await self.agents_client.threads.create()
-                    self.thread_id = self.thread.id
+                # Trust the stored thread without a probe; if it has been
+                # deleted, the first run replaces it (see _respond)
+                self.thread_id = existing_thread_id
+                self._thread_unverified = True
+                logger.info("Reconnected to existing thread: %s", self.thread_id)
             else:
                 # Create a new thread for this session
-                self.thread = await self.agents_client.threads.create()
-                self.thread_id = self.thread.id
+                thread = await self.agents_client.threads.create()
+                self.thread_id = thread.id
+                self._thread_unverified = False
             
             self._initialized = True
-            logger.info(f"Successfully initialized with agent: {self.agent.id} and thread: {self.thread_id}")
+            logger.info("Successfully initialized with agent: %s and thread: %s", self.agent.id, self.thread_id)
             return True
             
+        except ClientAuthenticationError as e:
+            # Surfaced by the first real call (get_agent); no separate token probe
+            logger.error("Authentication failed during initialization: %s", e)
+            await self.cleanup()
+            return False
         except Exception as e:
-            logger.error(f"Initialization failed: {e}")
+            logger.error("Initialization failed: %s", e)
             await self.cleanup()
             return False
     
     async def ensure_connected(self) -> bool:
         """Ensure the agent is connected, reconnect if needed"""
-        if not self._initialized:
+        if self._initialized:
+            return True
+        
+        # Serialize reconnects so racing messages don't each create a thread
+        async with self._connect_lock:
+            if self._initialized:
+                return True
             logger.info("Agent not initialized, attempting to reconnect...")
             # Try to reconnect with existing thread ID
-            stored_thread_id = cl.user_session.get("thread_id")
+            stored_thread_id = self.load_session_thread_id()
             success = await self.initialize(existing_thread_id=stored_thread_id)
             if success and self.thread_id:
                 # Update stored thread ID
-                cl.user_session.set("thread_id", self.thread_id)
+                self.save_session_thread_id(self.thread_id)
             return success
-        return True
     
     async def wake_up_agent(self) -> bool:
         """Send a wake-up message to the agent without displaying it to the user"""
@@ -104,143 +501,263 @@ class AzureAIAgent:
                 logger.error("Agents client is None")
                 return False
             
-            if not self.thread:
-                logger.error("Thread is None")
+            if not self.thread_id:
+                logger.error("Thread ID is None")
                 return False
             
             if not self.agent:
                 logger.error("Agent is None")
                 return False
                 
-            # Send a simple wake-up message
-            await self.agents_client.messages.create(
-                thread_id=self.thread.id,
-                role="user",
-                content="Hello, are you ready to assist?"
-            )
-            
-            # Create and execute run (don't stream, just wait for completion)
-            run = await self.agents_client.runs.create(
-                thread_id=self.thread.id,
-                agent_id=self.agent.id
-            )
-            
-            # Poll for completion (simple polling without streaming)
-            max_attempts = 30  # 30 seconds timeout
-            attempts = 0
+            # Create the run with the wake-up message attached, in one request
+            create = asyncio.ensure_future(self.agents_client.runs.create(
+                thread_id=self.thread_id,
+                agent_id=self.agent.id,
+                additional_messages=[
+                    ThreadMessageOptions(role="user", content="Hello, are you ready to assist?")
+                ]
+            ))
             
-            while run.status in ["queued", "in_progress", "requires_action"] and attempts < max_attempts:
-                await asyncio.sleep(1)
-                run = await self.agents_client.runs.get(
-                    thread_id=self.thread.id,
-                    run_id=run.id
+            # Wait for completion (don't stream, just poll with backoff)
+            try:
+                # Shielded so a cancel mid-request still yields the run to stop
+                run = await asyncio.shield(create)
+                run = await asyncio.wait_for(
+                    self._poll_run(thread_id=self.thread_id, run_id=run.id),
+                    timeout=WAKE_UP_TIMEOUT
                 )
-                attempts += 1
+            except asyncio.TimeoutError:
+                logger.warning("Agent wake-up timed out waiting for run completion")
+                # Cancel the stalled run so it stops holding server resources
+                await self._cancel_wake_up_run(run.id)
+                return True  # Consider it successful even if not "completed"
+            except asyncio.CancelledError:
+                # A user message arrived; free the thread for it right away
+                run = await create
+                await self._cancel_wake_up_run(run.id)
+                raise
             
             if run.status == "completed":
                 logger.info("Agent wake-up successful")
                 return True
             else:
-                logger.warning(f"Agent wake-up completed with status: {run.status}")
+                logger.warning("Agent wake-up completed with status: %s (%s)", run.status, _run_error_message(run))
                 return True  # Consider it successful even if not "completed"
                 
         except Exception as e:
-            logger.error(f"Agent wake-up failed: {e}")
+            logger.error("Agent wake-up failed: %s", e)
             return False
     
+    async def _cancel_wake_up_run(self, run_id: str) -> None:
+        """Cancel the wake-up run and wait until it no longer holds the thread"""
+        try:
+            run = await self.agents_client.runs.cancel(thread_id=self.thread_id, run_id=run_id)
+            if run.status in ACTIVE_RUN_STATUSES:
+                await asyncio.wait_for(
+                    self._poll_run(thread_id=self.thread_id, run_id=run_id),
+                    timeout=WAKE_UP_TIMEOUT
+                )
+        except Exception as e:
+            logger.warning("Could not cancel wake-up run %s: %s", run_id, e)
+    
+    def start_wake_up(self) -> None:
+        """Run the wake-up in the background so chat start doesn't wait on it"""
+        self._wake_task = asyncio.create_task(self.wake_up_agent())
+    
+    async def _poll_run(self, thread_id: str, run_id: str) -> ThreadRun:
+        """Wait for a run to leave the active statuses via the shared poll scheduler"""
+        return await poll_scheduler.register(thread_id, run_id)
+    
     async def send_message_streaming(self, message: str, message_placeholder: cl.Message) -> str:
         """Send message to agent and stream response as it's generated"""
+        # Follow-ups sent while a run is streaming are answered together next
+        if self._run_lock.locked():
+            self._pending_user_msgs.append((message, message_placeholder))
+            if self._pending_batch is None:
+                self._pending_batch = asyncio.get_running_loop().create_future()
+            batch_done = self._pending_batch
+            message_placeholder.content = QUEUED_MSG
+            await message_placeholder.update()
+            # Stay in flight until the batch is answered, so Chainlit's task
+            # state and Stop button keep tracking the reply
+            try:
+                return await asyncio.shield(batch_done)
+            except asyncio.CancelledError:
+                # Stop on a queued message also stops the run answering it
+                if not batch_done.done() and self._run_task is not None:
+                    self._run_task.cancel()
+                raise
+        
+        batch_done: Optional[asyncio.Future] = None
+        try:
+            async with self._run_lock:
+                self._run_task = asyncio.current_task()
+                response = await self._respond([message], message_placeholder)
+                while self._pending_user_msgs:
+                    batch, self._pending_user_msgs = self._pending_user_msgs, []
+                    batch_done, self._pending_batch = self._pending_batch, None
+                    # One run answers the whole batch, in the newest placeholder
+                    *answered, (_, placeholder) = batch
+                    for _, earlier_placeholder in answered:
+                        earlier_placeholder.content = COMBINED_MSG
+                        await earlier_placeholder.update()
+                    response = await self._respond([text for text, _ in batch], placeholder)
+                    batch_done.set_result(response)
+                return response
+        finally:
+            # The lock is already released, so a message arriving during the
+            # updates below starts its own run instead of queueing behind us
+            self._run_task = None
+            # A stopped run must not strand the handlers waiting on it, nor
+            # leave queued messages for the next run to answer out of order
+            if batch_done is not None and not batch_done.done():
+                batch_done.cancel()
+            if self._pending_user_msgs:
+                stranded, self._pending_user_msgs = self._pending_user_msgs, []
+                self._pending_batch.cancel()
+                self._pending_batch = None
+                for _, placeholder in stranded:
+                    placeholder.content = UNANSWERED_MSG
+                    await placeholder.update()
+    
+    async def _respond(self, messages: List[str], message_placeholder: cl.Message) -> str:
+        """Run the agent on the user messages, reporting failures in the placeholder"""
         try:
             # Ensure we're connected
             if not await self.ensure_connected():
                 return "Error: Could not establish connection to Azure AI Agent"
             
-            # Check if clients, agent, and thread are properly initialized
-            if not self._initialized or not self.agents_client:
-                return "Error: Agents client not initialized"
-            
-            if not self.agent:
-                return "Error: Agent not initialized"
-                
-            if not self.thread:
-                return "Error: Thread not initialized"
-            
-            # Create user message in the existing thread
-            await self.agents_client.messages.create(
-                thread_id=self.thread.id,
-                role="user",
-                content=message
-            )
+            # A successful ensure_connected guarantees client, agent and thread
+            assert self.agents_client and self.agent and self.thread_id
             
-            # Stream the agent response
-            streaming_content = ""
+            # A thread accepts no new messages while the wake-up run is active,
+            # so stop it rather than make the user wait for the greeting reply
+            if self._wake_task is not None:
+                wake_task, self._wake_task = self._wake_task, None
+                wake_task.cancel()
+                await asyncio.wait((wake_task,))
             
+            async with run_admission:
+                try:
+                    response = await self._stream_run(messages, message_placeholder)
+                except ResourceNotFoundError:
+                    # Only an unverified resumed thread may have vanished; any
+                    # other 404 (e.g. a deleted agent) is a real failure
+                    if not self._thread_unverified or not await self._thread_missing():
+                        raise
+                    logger.warning("Thread %s not found, starting a new thread", self.thread_id)
+                    thread = await self.agents_client.threads.create()
+                    self.thread_id = thread.id
+                    self._thread_unverified = False
+                    self.save_session_thread_id(self.thread_id)
+                    # Tell the user the earlier history did not carry over
+                    await cl.Message(content=THREAD_REPLACED_MSG, author="System").send()
+                    return await self._stream_run(messages, message_placeholder)
+                self._thread_unverified = False
+                return response
+                
+        except Exception as e:
+            logger.error("Message failed: %s", e)
+            # Try to reconnect on error
+            self._initialized = False
+            error_response = f"Connection lost. Reconnecting... Error: {str(e)}"
+            message_placeholder.content = error_response
+            await message_placeholder.update()
+            return error_response
+    
+    async def _thread_missing(self) -> bool:
+        """Confirm that this session's thread has been deleted"""
+        try:
+            await self.agents_client.threads.get(self.thread_id)
+        except ResourceNotFoundError:
+            return True
+        return False
+    
+    async def _stream_run(self, messages: List[str], message_placeholder: cl.Message) -> str:
+        """Post the user messages and stream the agent's reply into the placeholder"""
+        # Stream the agent response, coalescing deltas into fewer UI updates
+        parts: List[str] = []
+        buffer = StreamBuffer(message_placeholder)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        
+        # Bind per-event lookups to locals once, outside the hot loop
+        delta_event, done_event, error_event = _DELTA_EVENT, _DONE_EVENT, _ERROR_EVENT
+        run_failed_events = _RUN_FAILED_EVENTS
+        append_part, push = parts.append, buffer.push
+        
+        try:
+            # The user messages ride on the run request itself, saving the
+            # separate messages.create round-trip before the first token
             async with await self.agents_client.runs.stream(
-                thread_id=self.thread.id, 
-                agent_id=self.agent.id
+                thread_id=self.thread_id, 
+                agent_id=self.agent.id,
+                additional_messages=[
+                    ThreadMessageOptions(role="user", content=text) for text in messages
+                ]
             ) as stream:
                 async for event_type, event_data, _ in stream:
                     
-                    if isinstance(event_data, MessageDeltaChunk):
-                        # Append the new text delta to our streaming content
-                        if event_data.text:
-                            streaming_content += event_data.text
-                            # Update the UI with the accumulated content
-                            message_placeholder.content = streaming_content
-                            await message_placeholder.update()
-                    
-                    elif isinstance(event_data, ThreadMessage):
-                        logger.debug(f"ThreadMessage created. ID: {event_data.id}, Status: {event_data.status}")
+                    # Deltas dominate the stream: handle them first and move on
+                    if event_type == delta_event:
+                        text = event_data.text
+                        if not text:
+                            continue
+                        append_part(text)
+                        if push(text):
+                            # Let the flush and other sessions' tasks run before
+                            # draining more already-buffered deltas
+                            await asyncio.sleep(0)
+                        continue
                     
-                    elif isinstance(event_data, ThreadRun):
-                        logger.debug(f"ThreadRun status: {event_data.status}")
-                        if event_data.status == "failed":
-                            error_msg = "Agent run failed"
-                            message_placeholder.content = error_msg
-                            await message_placeholder.update()
-                            return error_msg
-                    
-                    elif isinstance(event_data, RunStep):
-                        logger.debug(f"RunStep type: {event_data.type}, Status: {event_data.status}")
+                    # Rare from here on: terminal and status events
+                    if event_type in run_failed_events:
+                        error_msg = f"Agent run {event_data.status}: {_run_error_message(event_data)}"
+                        logger.warning(error_msg)
+                        await buffer.close()
+                        message_placeholder.content = error_msg
+                        await message_placeholder.update()
+                        return error_msg
                     
-                    elif event_type == AgentStreamEvent.ERROR:
+                    elif event_type == error_event:
                         error_msg = f"An error occurred: {event_data}"
                         logger.error(error_msg)
+                        await buffer.close()
                         message_placeholder.content = error_msg
                         await message_placeholder.update()
                         return error_msg
                     
-                    elif event_type == AgentStreamEvent.DONE:
+                    elif event_type == done_event:
                         logger.debug("Stream completed.")
                         break
+                    
+                    # Status tracing only costs anything when debug logging is on
+                    elif debug:
+                        if isinstance(event_data, ThreadMessage):
+                            logger.debug("ThreadMessage created. ID: %s, Status: %s", event_data.id, event_data.status)
+                        elif isinstance(event_data, ThreadRun):
+                            logger.debug("ThreadRun status: %s", event_data.status)
+                        elif isinstance(event_data, RunStep):
+                            logger.debug("RunStep type: %s, Status: %s", event_data.type, event_data.status)
             
-            # Return the final accumulated content
-            return streaming_content if streaming_content else "No response received"
-                
-        except Exception as e:
-            logger.error(f"Message failed: {e}")
-            # Try to reconnect on error
-            self._initialized = False
-            error_response = f"Connection lost. Reconnecting... Error: {str(e)}"
-            message_placeholder.content = error_response
+            # Send the tail of the reply, then persist the message once
+            await buffer.close()
             await message_placeholder.update()
-            return error_response
+            
+            # Return the final accumulated content
+            return "".join(parts) or "No response received"
+        finally:
+            # A no-op after a clean close; if the stream raised, stop the
+            # in-flight flush so no stray tokens follow the error text
+            buffer.discard()
     
     async def cleanup(self) -> None:
-        """Close the project client and reset state"""
-        try:
-            if self.project_client and self._initialized:
-                await self.project_client.close()
-                logger.info("Azure AI client closed successfully")
-        except Exception as e:
-            logger.warning(f"Error during cleanup: {e}")
-        finally:
-            self.project_client = None
-            self.agents_client = None
-            self.agent = None
-            self.thread = None
-            # Don't reset thread_id here - keep it for reconnection
-            self._initialized = False
+        """Reset per-session state; the shared project client stays open"""
+        # Don't reset thread_id here - keep it for reconnection
+        self._initialized = False
+        # Stop a still-running wake-up; its cancel handler cancels the run
+        if self._wake_task is not None:
+            wake_task, self._wake_task = self._wake_task, None
+            wake_task.cancel()
 
 async def get_or_create_agent() -> AzureAIAgent:
     """Get existing agent from session or create a new one"""
@@ -252,11 +769,32 @@ async def get_or_create_agent() -> AzureAIAgent:
     
     return agent
 
+@cl.on_app_startup
+async def warmup():
+    """Prime the token, connection pool and agent handle before the first chat"""
+    if SKIP_WARMUP or not CONFIG_OK:
+        return
+    try:
+        await get_agent()
+        logger.info("Warm-up complete: shared client and agent are ready")
+    except Exception as e:
+        # Not fatal - the first chat start retries initialization
+        logger.warning("Warm-up failed: %s", e)
+
+@cl.on_app_shutdown
+async def shutdown():
+    """Release the shared connection pool and credential once per process"""
+    try:
+        await close_shared_clients()
+        logger.info("Azure AI client closed successfully")
+    except Exception as e:
+        logger.warning("Error during shutdown: %s", e)
+
 @cl.on_chat_start
 async def start():
     """Initialize chat session"""
     init_msg = cl.Message(
-        content="🤖 Initializing Azure AI Agent...",
+        content=INIT_PENDING_MSG,
         author="System"
     )
     await init_msg.send()
@@ -265,44 +803,31 @@ async def start():
     agent = await get_or_create_agent()
     
     # Check if we have an existing thread ID
-    existing_thread_id = cl.user_session.get("thread_id")
+    existing_thread_id = agent.load_session_thread_id()
     
     if await agent.initialize(existing_thread_id=existing_thread_id):
-        if agent.agent and agent.thread:
+        if agent.agent and agent.thread_id:
             # Store the thread ID for reconnection
-            cl.user_session.set("thread_id", agent.thread_id)
-            
-            # Update initialization message
-            init_msg.content = "🤖 Waking up agent..."
-            await init_msg.update()
-            
-            # Wake up the agent automatically
-            wake_up_success = await agent.wake_up_agent()
+            agent.save_session_thread_id(agent.thread_id)
             
             # Prepare status message
-            status_msg = f"✅ Connected to Azure AI Agent: {agent.agent.id}\n"
             if existing_thread_id and existing_thread_id == agent.thread_id:
-                status_msg += f"Resumed conversation in thread: {agent.thread_id}\n\n"
-                if wake_up_success:
-                    status_msg += "Welcome back! Your conversation history is preserved and the agent is ready."
-                else:
-                    status_msg += "Welcome back! Your conversation history is preserved. (Agent wake-up had issues, but should still work)"
+                # A resumed thread needs no priming message in its history
+                template = RESUMED_READY_MSG
             else:
-                status_msg += f"New conversation thread: {agent.thread_id}\n\n"
-                if wake_up_success:
-                    status_msg += "Agent is warmed up and ready! How can I help you?"
-                else:
-                    status_msg += "Agent initialized (wake-up had issues, but should still work). How can I help you?"
+                # Wake up a fresh agent in the background while the user types
+                agent.start_wake_up()
+                template = NEW_THREAD_READY_MSG
             
             # Update with final status
-            init_msg.content = status_msg
+            init_msg.content = template.format(agent_id=agent.agent.id, thread_id=agent.thread_id)
             await init_msg.update()
             
         else:
-            init_msg.content = "❌ Agent initialization incomplete."
+            init_msg.content = INIT_INCOMPLETE_MSG
             await init_msg.update()
     else:
-        init_msg.content = "❌ Failed to connect to Azure AI Agent. Please check configuration."
+        init_msg.content = INIT_FAILURE_MSG
         await init_msg.update()
 
 @cl.on_message
@@ -313,7 +838,7 @@ async def main(message: cl.Message):
     
     # Create a placeholder message for streaming
     msg = cl.Message(
-        content="🤖 *Thinking...*",
+        content=THINKING_MSG,
         author="Assistant"
     )
     await msg.send()